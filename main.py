@@ -1,10 +1,30 @@
 import requests
 import json
 from flask import Flask, request, Response, jsonify
+from werkzeug.serving import WSGIRequestHandler
+from werkzeug.wsgi import ClosingIterator
 import time
 import uuid
 import random
+import copy
+import re
 import os
+import sys
+import signal
+import threading
+import queue
+import itertools
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import hashlib
+import gzip
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None  # 未安装brotli时只使用gzip
 
 app = Flask(__name__)
 
@@ -16,24 +36,297 @@ MODEL_MAPPING = {
     # },
     "claude-3-7-sonnet-20250219": {
         "model_id": "be71f37b-1487-49fa-a989-a9bb99c0b129", 
-        "max_tokens": 64000
+        "max_tokens": 64000,
+        "context_window": 200000
     },
     "claude-4-opus-20250514": {
         "model_id": "bebc7dd5-a24d-4147-85b0-8f62902ea1a3",
-        "max_tokens": 32000
+        "max_tokens": 32000,
+        "context_window": 200000
     },
     "claude-4-sonnet": {
         "model_id": "884dde7c-8def-4365-b19a-57af2787ab84",
-        "max_tokens": 64000
+        "max_tokens": 64000,
+        "context_window": 200000
     }
 }
 
+# 可选的服务端max_tokens上限，JSON格式，如 {"claude-4-opus-20250514": 4096}
+for _model_name, _cap in json.loads(os.environ.get('MAX_TOKENS_CAPS', '{}')).items():
+    if _model_name in MODEL_MAPPING:
+        MODEL_MAPPING[_model_name]['max_tokens_cap'] = int(_cap)
+
+# 客户端未指定任何采样参数（temperature/top_p/top_k）时使用的默认值
+DEFAULT_TEMPERATURE = 0.08
+DEFAULT_TOP_P = 0.14
+DEFAULT_TOP_K = 1
+
+# 本地token估算：每条消息的固定开销，以及按消息缓存的条目数
+MESSAGE_TOKEN_OVERHEAD = 4
+# 图片等非文本部分按固定值估算（Claude每张图片最多约1600 tokens）
+IMAGE_TOKEN_ESTIMATE = 1600
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', '8192'))
+
+# 中日韩字符大约每个字符一个token
+CJK_PATTERN = re.compile(r'[\u3000-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uff00-\uffef]')
+
+# 单个请求允许的最大choice数量（OpenAI的n参数）
+MAX_CHOICES = int(os.environ.get('MAX_CHOICES', '8'))
+
+# 小于该字节数的响应不压缩
+COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', '1024'))
+
+# 是否对SSE流式响应启用gzip压缩（每个chunk后同步刷新）
+SSE_COMPRESSION = os.environ.get('SSE_COMPRESSION', '').lower() in ('1', 'true', 'yes')
+
+# 收到SIGTERM后等待进行中请求完成的最长时间（秒）
+DRAIN_TIMEOUT = float(os.environ.get('DRAIN_TIMEOUT', '30'))
+
+# 采样分析端点允许的最长采样时间（秒）
+PROFILE_MAX_SECONDS = float(os.environ.get('PROFILE_MAX_SECONDS', '60'))
+
+# 对冲请求：首包超过阈值仍未到达时并行发起第二次尝试（默认关闭）
+HEDGE_ENABLED = os.environ.get('HEDGE_ENABLED', '').lower() in ('1', 'true', 'yes')
+# 固定的对冲阈值（秒），不设置时使用最近首包耗时的p95
+HEDGE_AFTER_SECONDS = float(os.environ.get('HEDGE_AFTER_SECONDS', '0'))
+# 样本不足时使用的对冲阈值（秒）
+HEDGE_DEFAULT_SECONDS = float(os.environ.get('HEDGE_DEFAULT_SECONDS', '5'))
+# 对冲请求数占总请求数的最大比例，用于限制浪费的生成
+HEDGE_MAX_RATIO = float(os.environ.get('HEDGE_MAX_RATIO', '0.1'))
+
 def validate_model(model_name):
     """验证模型名称是否存在"""
     if model_name not in MODEL_MAPPING:
         return False, f"模型 '{model_name}' 不存在。支持的模型: {', '.join(MODEL_MAPPING.keys())}"
     return True, None
 
+def effective_max_tokens(model_config):
+    """模型上限与服务端上限中较小的一个"""
+    return min(model_config['max_tokens'], model_config.get('max_tokens_cap', model_config['max_tokens']))
+
+def validate_sampling_params(data, model_name):
+    """验证客户端的采样参数，返回 (采样参数, 错误信息, 出错的参数名)"""
+    model_config = MODEL_MAPPING[model_name]
+    sampling = {}
+    
+    max_tokens = data.get('max_tokens', data.get('max_completion_tokens'))
+    if max_tokens is not None:
+        if not isinstance(max_tokens, int) or isinstance(max_tokens, bool) or max_tokens < 1:
+            return None, "参数 'max_tokens' 必须是正整数", "max_tokens"
+        if max_tokens > model_config['max_tokens']:
+            return None, f"参数 'max_tokens' 超过模型 '{model_name}' 的上限 {model_config['max_tokens']}", "max_tokens"
+        # 超过服务端上限时静默截断
+        sampling['max_tokens'] = min(max_tokens, effective_max_tokens(model_config))
+    
+    # Claude的temperature只接受0-1，超出范围直接拒绝而不是静默截断
+    for name, upper in (('temperature', 1.0), ('top_p', 1.0)):
+        value = data.get(name)
+        if value is None:
+            continue
+        if not isinstance(value, (int, float)) or isinstance(value, bool) or not 0 <= value <= upper:
+            return None, f"参数 '{name}' 必须是 0 到 {upper} 之间的数字", name
+        sampling[name] = float(value)
+    
+    top_k = data.get('top_k')
+    if top_k is not None:
+        if not isinstance(top_k, int) or isinstance(top_k, bool) or top_k < 1:
+            return None, "参数 'top_k' 必须是正整数", "top_k"
+        sampling['top_k'] = top_k
+    
+    stop = data.get('stop')
+    if stop is not None:
+        if isinstance(stop, str):
+            stop = [stop]
+        if (not isinstance(stop, list) or len(stop) > 4
+                or not all(isinstance(s, str) and s for s in stop)):
+            return None, "参数 'stop' 必须是非空字符串或最多4个非空字符串的数组", "stop"
+        sampling['stop'] = stop
+    
+    return sampling, None, None
+
+def build_upstream_params(model_config, sampling=None):
+    """构造FreePlay请求中的params字段"""
+    sampling = sampling or {}
+    max_tokens = sampling.get('max_tokens', effective_max_tokens(model_config))
+    params = [
+        {
+            "initial_value": max_tokens,
+            "is_advanced": False,
+            "name": "max_tokens",
+            "nested_fields": None,
+            "range": None,
+            "str_options": None,
+            "tooltipText": None,
+            "type": "integer",
+            "value": max_tokens
+        }
+    ]
+    
+    # 客户端指定了任意采样参数时只发送客户端给出的参数，其余使用上游默认值；
+    # 否则沿用默认的低随机性参数
+    if not any(name in sampling for name in ('temperature', 'top_p', 'top_k')):
+        sampling = dict(sampling, temperature=DEFAULT_TEMPERATURE, top_p=DEFAULT_TOP_P, top_k=DEFAULT_TOP_K)
+    for name, value_type in (('temperature', 'float'), ('top_p', 'float'), ('top_k', 'integer')):
+        if name in sampling:
+            params.append({
+                "name": name,
+                "value": sampling[name],
+                "type": value_type
+            })
+    return params
+
+def estimate_text_tokens(text):
+    """粗略估算文本的token数：中日韩字符约1个token，其余约4个字符1个token"""
+    if not text:
+        return 0
+    other_chars = len(CJK_PATTERN.sub('', text))
+    return (len(text) - other_chars) + (other_chars + 3) // 4
+
+# 按 (role, 文本摘要) 缓存的消息token数，只保存摘要而不保存消息正文
+token_cache = OrderedDict()
+token_cache_lock = threading.Lock()
+
+def estimate_message_tokens(role, text):
+    """估算单条消息文本的token数，按内容摘要缓存，长对话的公共前缀在多次请求间只计算一次"""
+    key = (role, hashlib.blake2b(text.encode('utf-8', 'surrogatepass'), digest_size=16).digest())
+    with token_cache_lock:
+        tokens = token_cache.get(key)
+        if tokens is not None:
+            token_cache.move_to_end(key)
+            return tokens
+    
+    tokens = MESSAGE_TOKEN_OVERHEAD + estimate_text_tokens(role) + estimate_text_tokens(text)
+    with token_cache_lock:
+        token_cache[key] = tokens
+        if len(token_cache) > TOKEN_CACHE_SIZE:
+            token_cache.popitem(last=False)
+    return tokens
+
+def completion_finish_reason(freeplay_data):
+    """上游正常结束（收到cost）时的finish_reason：上游给出max_tokens/length时为length，否则为stop"""
+    upstream_reason = freeplay_data.get('stop_reason') or freeplay_data.get('finish_reason')
+    return 'length' if upstream_reason in ('max_tokens', 'length') else 'stop'
+
+def split_message_content(content):
+    """把消息内容拆分为 (文本, 非文本部分数量)，多模态内容只取text部分作为文本"""
+    if isinstance(content, str):
+        return content, 0
+    if isinstance(content, list):
+        texts = []
+        other_parts = 0
+        for part in content:
+            if isinstance(part, dict) and isinstance(part.get('text'), str):
+                texts.append(part['text'])
+            else:
+                other_parts += 1
+        return "\n".join(texts), other_parts
+    return ("" if content is None else json.dumps(content, ensure_ascii=False)), 0
+
+def estimate_prompt_tokens(messages):
+    """估算整个messages的token数"""
+    total = 3  # 回复开头的固定开销
+    for message in messages:
+        text, other_parts = split_message_content(message.get('content'))
+        total += estimate_message_tokens(str(message.get('role', '')), text)
+        total += other_parts * IMAGE_TOKEN_ESTIMATE
+    return total
+
+def validate_context_length(messages, model_name, sampling):
+    """检查请求是否超出模型上下文窗口，返回 (估算的prompt token数, 错误信息)"""
+    context_window = MODEL_MAPPING[model_name]['context_window']
+    prompt_tokens = estimate_prompt_tokens(messages)
+    # 只有客户端显式指定max_tokens时才把输出长度计入
+    requested = prompt_tokens + sampling.get('max_tokens', 0)
+    if requested > context_window:
+        return prompt_tokens, (
+            f"模型 '{model_name}' 的最大上下文长度为 {context_window} tokens，"
+            f"但本次请求估算需要 {requested} tokens（messages {prompt_tokens} + max_tokens {sampling.get('max_tokens', 0)}）"
+        )
+    return prompt_tokens, None
+
+class StopSequenceMatcher:
+    """在代理侧检测stop序列（FreePlay不支持stop参数）
+    
+    为处理跨chunk的匹配，会暂存最长stop序列长度减一的尾部文本。
+    """
+    def __init__(self, stops=None):
+        self.stops = stops or []
+        self.holdback = max((len(s) for s in self.stops), default=1) - 1
+        self.buffer = ""
+    
+    def feed(self, text):
+        """输入新文本，返回 (可以输出的文本, 是否命中stop序列)"""
+        if not self.stops:
+            return text, False
+        self.buffer += text
+        hits = [pos for pos in (self.buffer.find(s) for s in self.stops) if pos != -1]
+        if hits:
+            output = self.buffer[:min(hits)]
+            self.buffer = ""
+            return output, True
+        split = max(0, len(self.buffer) - self.holdback)
+        output, self.buffer = self.buffer[:split], self.buffer[split:]
+        return output, False
+    
+    def flush(self):
+        """上游结束时输出剩余的暂存文本"""
+        output, self.buffer = self.buffer, ""
+        return output
+
+class RequestTimer:
+    """记录单个请求各阶段的耗时，用于Server-Timing响应头（仅非流式响应）和结构化日志
+    
+    并发执行的部分（n > 1 的各个choice、对冲请求）通过 scoped() 记录到带后缀的阶段，
+    避免不同线程的耗时相加后超过总耗时。
+    """
+    def __init__(self):
+        self.request_id = uuid.uuid4().hex[:12]
+        self.started = time.perf_counter()
+        self.phases = {}
+        self.lock = threading.Lock()
+        self.suffix = ""
+    
+    def scoped(self, suffix):
+        """返回共享同一份记录、但阶段名带有后缀的计时器"""
+        child = copy.copy(self)
+        child.suffix = self.suffix + suffix
+        return child
+    
+    def add(self, phase, seconds):
+        """累加某个阶段的耗时（同一线程内的重试等会累加）"""
+        phase += self.suffix
+        with self.lock:
+            self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+    
+    @contextmanager
+    def measure(self, phase):
+        """统计代码块耗时并计入指定阶段"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(phase, time.perf_counter() - start)
+    
+    def snapshot(self):
+        """返回各阶段及总耗时（毫秒）"""
+        with self.lock:
+            phases = {name: round(seconds * 1000, 1) for name, seconds in self.phases.items()}
+        phases['total'] = round((time.perf_counter() - self.started) * 1000, 1)
+        return phases
+    
+    def server_timing(self):
+        """生成Server-Timing响应头的值"""
+        return ", ".join(f"{name};dur={ms}" for name, ms in self.snapshot().items())
+    
+    def log(self, **fields):
+        """以单行JSON输出结构化耗时日志"""
+        print(json.dumps({
+            "event": "request_timing",
+            "request_id": self.request_id,
+            "phases_ms": self.snapshot(),
+            **fields
+        }, ensure_ascii=False))
+
 def get_account_balance(session_id):
     """获取账号余额信息"""
     try:
@@ -93,6 +386,7 @@ class AccountPool:
         self.accounts_file = accounts_file
         self.accounts = []
         self.current_index = 0  # 当前账号索引，用于顺序选择
+        self.lock = threading.RLock()  # 保护current_index和账号文件写入，n > 1 时多个线程会并发访问
         self.load_accounts()
     
     def load_accounts(self):
@@ -149,13 +443,18 @@ class AccountPool:
             return False
     
     def get_current_account(self):
-        """获取当前账号，如果余额不足则切换到下一个有余额的账号"""
+        """获取当前账号，如果余额不足则切换到下一个有余额的账号
+        
+        锁只保护current_index的读取和推进，余额查询在锁外进行，避免并发请求排队等待网络调用。
+        """
         if not self.accounts:
             return None
         
         # 首先检查当前账号是否可用
-        current_account = self.accounts[self.current_index]
-        print(f"检查当前账号 {current_account['email']} (索引: {self.current_index}, 余额: ${current_account['balance']:.4f})")
+        with self.lock:
+            index = self.current_index
+        current_account = self.accounts[index]
+        print(f"检查当前账号 {current_account['email']} (索引: {index}, 余额: ${current_account['balance']:.4f})")
         
         # 如果当前账号余额充足，直接使用
         if current_account['balance'] > 0.01:
@@ -166,13 +465,15 @@ class AccountPool:
         print(f"当前账号 {current_account['email']} 余额不足，寻找下一个可用账号...")
         
         # 尝试所有账号，从下一个开始
-        attempts = 0
-        while attempts < len(self.accounts):
-            # 移动到下一个账号
-            self.current_index = (self.current_index + 1) % len(self.accounts)
-            account = self.accounts[self.current_index]
+        for _ in range(len(self.accounts)):
+            # 移动到下一个账号；其他线程已经切换过时从它选中的账号继续
+            with self.lock:
+                if self.current_index == index:
+                    self.current_index = (index + 1) % len(self.accounts)
+                index = self.current_index
+            account = self.accounts[index]
             
-            print(f"尝试账号 {account['email']} (索引: {self.current_index}, 当前余额: ${account['balance']:.4f})")
+            print(f"尝试账号 {account['email']} (索引: {index}, 当前余额: ${account['balance']:.4f})")
             
             # 如果账号余额大于0.01，更新余额并检查
             if account['balance'] > 0.01:
@@ -187,17 +488,26 @@ class AccountPool:
                     print(f"账号 {account['email']} 更新后余额不足，继续下一个账号")
             else:
                 print(f"账号 {account['email']} 余额不足，跳过")
-            
-            attempts += 1
         
         print("警告: 所有账号都不可用")
         return None
     
+    def get_alternate_account(self, excluded_sessions):
+        """从当前账号之后找一个不在排除列表中的可用账号（用于对冲请求），不改变current_index"""
+        with self.lock:
+            start = self.current_index
+        for offset in range(1, len(self.accounts) + 1):
+            account = self.accounts[(start + offset) % len(self.accounts)]
+            if account['session_id'] not in excluded_sessions and account['balance'] > 0.01:
+                return account
+        return None
+    
     def move_to_next_account(self):
         """移动到下一个账号（用于错误重试时）"""
-        if self.accounts:
-            self.current_index = (self.current_index + 1) % len(self.accounts)
-            print(f"切换到下一个账号，当前索引: {self.current_index}")
+        with self.lock:
+            if self.accounts:
+                self.current_index = (self.current_index + 1) % len(self.accounts)
+                print(f"切换到下一个账号，当前索引: {self.current_index}")
     
     def get_account_by_session(self, session_id):
         """根据session_id获取账号"""
@@ -214,20 +524,83 @@ class AccountPool:
                 break
     
     def save_accounts(self):
-        """保存账号信息到文件"""
+        """保存账号信息到文件（先写临时文件再原子替换，避免写入中断导致文件损坏）"""
+        tmp_file = f"{self.accounts_file}.tmp"
         try:
-            with open(self.accounts_file, 'w', encoding='utf-8') as f:
-                for account in self.accounts:
-                    line = f"{account['email']}----{account['password']}----{account['session_id']}----{account['project_id']}----{account['balance']:.4f}\n"
-                    f.write(line)
+            with self.lock:
+                with open(tmp_file, 'w', encoding='utf-8') as f:
+                    for account in self.accounts:
+                        line = f"{account['email']}----{account['password']}----{account['session_id']}----{account['project_id']}----{account['balance']:.4f}\n"
+                        f.write(line)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_file, self.accounts_file)
         except Exception as e:
             print(f"保存账号文件时出错: {e}")
 
 # 初始化账号池
 account_pool = AccountPool()
 
-def call_freeplay_api_with_retry(messages, stream=False, model="claude-3-7-sonnet-20250219", max_retries=None):
-    """调用FreePlay API，支持自动重试不同账号"""
+class DrainState:
+    """跟踪进行中的补全请求，进入排空状态后拒绝新请求"""
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.active = 0
+        self.draining = False
+    
+    def try_enter(self):
+        """登记一个新请求，排空中返回False"""
+        with self.condition:
+            if self.draining:
+                return False
+            self.active += 1
+            return True
+    
+    def leave(self):
+        """请求结束（流式响应在流关闭时调用）"""
+        with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+    
+    def start_draining(self):
+        """进入排空状态，返回是否是第一次进入"""
+        with self.condition:
+            first = not self.draining
+            self.draining = True
+            return first
+    
+    def wait_idle(self, timeout):
+        """等待所有进行中的请求完成，超时返回False"""
+        with self.condition:
+            return self.condition.wait_for(lambda: self.active == 0, timeout)
+
+drain_state = DrainState()
+
+def graceful_shutdown():
+    """等待进行中的请求完成（最多DRAIN_TIMEOUT秒），保存账号状态后退出进程"""
+    print(f"开始排空，等待 {drain_state.active} 个进行中的请求完成（最多 {DRAIN_TIMEOUT} 秒）...")
+    if drain_state.wait_idle(DRAIN_TIMEOUT):
+        print("所有请求已完成")
+    else:
+        print(f"警告: 排空超时，仍有 {drain_state.active} 个请求将被中断")
+    account_pool.save_accounts()
+    print("账号状态已保存，退出进程")
+    sys.stdout.flush()
+    os._exit(0)
+
+def handle_sigterm(signum, frame):
+    """收到SIGTERM后进入排空状态，在后台线程中完成退出，期间服务继续处理已有请求"""
+    if drain_state.start_draining():
+        threading.Thread(target=graceful_shutdown, daemon=True).start()
+
+def call_freeplay_api_with_retry(messages, stream=False, model="claude-3-7-sonnet-20250219", max_retries=None, timer=None, sampling=None, excluded_sessions=None, on_account=None, abandoned=None):
+    """调用FreePlay API，支持自动重试不同账号
+    
+    excluded_sessions 不为None时（对冲请求）只使用其中不包含的账号，每次失败的账号也会加入排除列表；
+    on_account 在每次选定账号后被调用；abandoned（threading.Event）被设置后不再选择新账号重试。
+    """
+    if timer is None:
+        timer = RequestTimer()
     if max_retries is None:
         max_retries = len(account_pool.accounts)  # 最多重试所有账号
     
@@ -239,15 +612,27 @@ def call_freeplay_api_with_retry(messages, stream=False, model="claude-3-7-sonne
     model_config = MODEL_MAPPING[model]
     
     for retry_count in range(max_retries):
-        # 获取当前可用账号
-        account = account_pool.get_current_account()
+        # 对冲中已落败的尝试不再占用新的账号
+        if abandoned is not None and abandoned.is_set():
+            break
+        
+        # 获取当前可用账号（可能包含同步的余额查询请求）
+        with timer.measure('account'):
+            if excluded_sessions is None:
+                account = account_pool.get_current_account()
+            else:
+                account = account_pool.get_alternate_account(excluded_sessions)
         if not account:
             raise Exception("没有可用的账号")
+        if excluded_sessions is not None:
+            excluded_sessions.add(account['session_id'])
+        if on_account is not None:
+            on_account(account)
         
         print(f"[DEBUG] 尝试第 {retry_count + 1} 次，选择的账号: {account['email']}")
         print(f"[DEBUG] 使用模型: {model}")
         print(f"[DEBUG] Model ID: {model_config['model_id']}")
-        print(f"[DEBUG] Max Tokens: {model_config['max_tokens']}")
+        print(f"[DEBUG] Max Tokens: {(sampling or {}).get('max_tokens', effective_max_tokens(model_config))}")
         print(f"[DEBUG] Project ID: {account['project_id']}")
         print(f"[DEBUG] Session ID: {account['session_id'][:20]}...")
         
@@ -268,34 +653,7 @@ def call_freeplay_api_with_retry(messages, stream=False, model="claude-3-7-sonne
         # JSON数据
         json_data = {
             "messages": messages,
-            "params": [
-                {
-                    "initial_value": model_config['max_tokens'],
-                    "is_advanced": False,
-                    "name": "max_tokens",
-                    "nested_fields": None,
-                    "range": None,
-                    "str_options": None,
-                    "tooltipText": None,
-                    "type": "integer",
-                    "value": model_config['max_tokens']
-                },
-                {
-                    "name": "temperature",
-                    "value": 0.08,
-                    "type": "float"
-                },
-                {
-                    "name": "top_p",
-                    "value": 0.14,
-                    "type": "float"
-                },
-                {
-                    "name": "top_k",
-                    "value": 1,
-                    "type": "integer"
-                }
-            ],
+            "params": build_upstream_params(model_config, sampling),
             "model_id": model_config['model_id'],
             "variables": {},
             "history": None,
@@ -313,7 +671,12 @@ def call_freeplay_api_with_retry(messages, stream=False, model="claude-3-7-sonne
         print(f"[DEBUG] Cookies: {cookies}")
         
         try:
-            response = requests.post(url, headers=headers, cookies=cookies, files=files, stream=True)
+            # stream=True 时post在收到响应头后返回，即连接建立+上游首包前的耗时
+            with timer.measure('upstream_connect'):
+                response = requests.post(url, headers=headers, cookies=cookies, files=files, stream=True)
+            if abandoned is not None and abandoned.is_set():
+                response.close()
+                break
             print(f"[DEBUG] 响应状态码: {response.status_code}")
             print(f"[DEBUG] 响应头: {dict(response.headers)}")
             
@@ -353,19 +716,22 @@ def call_freeplay_api_with_retry(messages, stream=False, model="claude-3-7-sonne
             print(f"[DEBUG] 账号 {account['email']} 请求异常: {e}，尝试下一个账号")
             continue
     
+    if abandoned is not None and abandoned.is_set():
+        raise Exception("上游请求已被放弃")
+    
     # 所有账号都尝试失败
     raise Exception(f"所有账号都无法完成请求，已尝试 {max_retries} 次")
 
-def call_freeplay_api(messages, stream=False, account=None, model="claude-3-7-sonnet-20250219"):
+def call_freeplay_api(messages, stream=False, account=None, model="claude-3-7-sonnet-20250219", sampling=None):
     """调用FreePlay API（兼容性函数）"""
     if account:
         # 如果指定了账号，使用原来的逻辑
-        return call_freeplay_api_single(messages, stream, account, model)
+        return call_freeplay_api_single(messages, stream, account, model, sampling)
     else:
         # 如果没有指定账号，使用重试逻辑
-        return call_freeplay_api_with_retry(messages, stream, model)
+        return call_freeplay_api_with_retry(messages, stream, model, sampling=sampling)
 
-def call_freeplay_api_single(messages, stream=False, account=None, model="claude-3-7-sonnet-20250219"):
+def call_freeplay_api_single(messages, stream=False, account=None, model="claude-3-7-sonnet-20250219", sampling=None):
     """调用FreePlay API（单个账号版本）"""
     if not account:
         raise Exception("必须指定账号")
@@ -380,7 +746,7 @@ def call_freeplay_api_single(messages, stream=False, account=None, model="claude
     print(f"[DEBUG] 选择的账号: {account['email']}")
     print(f"[DEBUG] 使用模型: {model}")
     print(f"[DEBUG] Model ID: {model_config['model_id']}")
-    print(f"[DEBUG] Max Tokens: {model_config['max_tokens']}")
+    print(f"[DEBUG] Max Tokens: {(sampling or {}).get('max_tokens', effective_max_tokens(model_config))}")
     print(f"[DEBUG] Project ID: {account['project_id']}")
     print(f"[DEBUG] Session ID: {account['session_id'][:20]}...")
     
@@ -401,34 +767,7 @@ def call_freeplay_api_single(messages, stream=False, account=None, model="claude
     # JSON数据
     json_data = {
         "messages": messages,
-        "params": [
-            {
-                "initial_value": model_config['max_tokens'],
-                "is_advanced": False,
-                "name": "max_tokens",
-                "nested_fields": None,
-                "range": None,
-                "str_options": None,
-                "tooltipText": None,
-                "type": "integer",
-                "value": model_config['max_tokens']
-            },
-            {
-                "name": "temperature",
-                "value": 0.08,
-                "type": "float"
-            },
-            {
-                "name": "top_p",
-                "value": 0.14,
-                "type": "float"
-            },
-            {
-                "name": "top_k",
-                "value": 1,
-                "type": "integer"
-            }
-        ],
+        "params": build_upstream_params(model_config, sampling),
         "model_id": model_config['model_id'],
         "variables": {},
         "history": None,
@@ -466,182 +805,411 @@ def call_freeplay_api_single(messages, stream=False, account=None, model="claude
         print(f"[DEBUG] 请求异常: {e}")
         raise
 
-def generate_openai_stream_response(messages, model="claude-3-7-sonnet-20250219"):
-    """生成OpenAI格式的流式响应"""
-    try:
-        response, account = call_freeplay_api_with_retry(messages, stream=True, model=model)
-        chat_id = f"chatcmpl-{uuid.uuid4().hex[:29]}"
-        created = int(time.time())
+def iter_freeplay_events(response, cancelled=None, timer=None):
+    """解析FreePlay的SSE响应，逐条产出数据字典"""
+    if timer is None:
+        timer = RequestTimer()
+    waiting_since = time.perf_counter()
+    for line in response.iter_lines(decode_unicode=True):
+        if waiting_since is not None:
+            # 从收到响应头到收到第一行数据的耗时
+            timer.add('upstream_ttfb', time.perf_counter() - waiting_since)
+            waiting_since = None
+        if cancelled is not None and cancelled.is_set():
+            break
+        if line and line.startswith('data: '):
+            try:
+                with timer.measure('parse'):
+                    freeplay_data = json.loads(line[6:])  # 去掉 'data: ' 前缀
+            except json.JSONDecodeError as e:
+                print(f"JSON decode error: {e}, line: {line}")
+                continue
+            yield freeplay_data
+
+class HedgeStats:
+    """对冲请求的统计信息：首包耗时样本、请求数、对冲数和对冲胜出数"""
+    MIN_SAMPLES = 20
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.first_byte_samples = deque(maxlen=500)
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.capped = 0
+    
+    def record_request(self):
+        with self.lock:
+            self.requests += 1
+    
+    def record_first_byte(self, seconds):
+        with self.lock:
+            self.first_byte_samples.append(seconds)
+    
+    def record_win(self):
+        with self.lock:
+            self.hedge_wins += 1
+    
+    def threshold(self):
+        """当前的对冲阈值（秒）"""
+        if HEDGE_AFTER_SECONDS > 0:
+            return HEDGE_AFTER_SECONDS
+        with self.lock:
+            samples = sorted(self.first_byte_samples)
+        if len(samples) < self.MIN_SAMPLES:
+            return HEDGE_DEFAULT_SECONDS
+        return samples[int(len(samples) * 0.95) - 1]
+    
+    def try_acquire(self):
+        """在对冲比例上限内登记一次对冲，超出上限返回False"""
+        with self.lock:
+            if self.hedged >= self.requests * HEDGE_MAX_RATIO:
+                self.capped += 1
+                return False
+            self.hedged += 1
+            return True
+    
+    def snapshot(self):
+        threshold = self.threshold()
+        with self.lock:
+            return {
+                "enabled": HEDGE_ENABLED,
+                "requests": self.requests,
+                "hedged": self.hedged,
+                "hedge_wins": self.hedge_wins,
+                "capped": self.capped,
+                "threshold_seconds": round(threshold, 3),
+                "max_ratio": HEDGE_MAX_RATIO
+            }
+
+hedge_stats = HedgeStats()
+
+class UpstreamAttempt:
+    """一次上游尝试，在后台线程中读取到第一条数据后把结果放入队列"""
+    def __init__(self, results, hedge=False):
+        self.results = results
+        self.hedge = hedge
+        self.response = None
+        self.session_id = None
+        self.abandoned = threading.Event()
+        self.started = time.perf_counter()
+        self.sample_lock = threading.Lock()
+        self.sampled = False
+    
+    def record_first_byte(self):
+        """记录首包耗时样本，每次尝试只记录一次"""
+        with self.sample_lock:
+            if self.sampled:
+                return
+            self.sampled = True
+        hedge_stats.record_first_byte(time.perf_counter() - self.started)
+    
+    def set_account(self, account):
+        self.session_id = account['session_id']
+    
+    def run(self, messages, model, timer, sampling, cancelled, excluded_sessions=None):
+        try:
+            response, account = call_freeplay_api_with_retry(
+                messages, stream=True, model=model, timer=timer, sampling=sampling,
+                excluded_sessions=excluded_sessions, on_account=self.set_account, abandoned=self.abandoned
+            )
+            self.response = response
+            # 建立连接期间已被取消，直接关闭
+            if self.abandoned.is_set():
+                response.close()
+                return
+            freeplay_events = iter_freeplay_events(response, cancelled, timer)
+            first = next(freeplay_events, None)
+            self.record_first_byte()
+            if first is not None:
+                freeplay_events = itertools.chain([first], freeplay_events)
+            self.results.put((self, account, freeplay_events, None))
+        except Exception as e:
+            self.results.put((self, None, None, e))
+    
+    def cancel(self):
+        """放弃该尝试并立即关闭上游连接
         
-        print(f"使用账号: {account['email']} (余额: ${account['balance']:.2f})")
+        尚未收到首包时把已等待的时间作为删失样本记录，避免p95只由快速响应构成而不断下降。
+        """
+        self.abandoned.set()
+        self.record_first_byte()
+        if self.response is not None:
+            self.response.close()
+
+def open_upstream(messages, model, timer, sampling=None, cancelled=None):
+    """发起上游请求，返回 (response, account, 数据迭代器)
+    
+    启用对冲时，若首包超过阈值仍未到达则使用另一个账号并行发起第二次尝试，先产出数据的一方胜出，另一方立即关闭。
+    """
+    if not HEDGE_ENABLED:
+        response, account = call_freeplay_api_with_retry(messages, stream=True, model=model, timer=timer, sampling=sampling)
+        return response, account, iter_freeplay_events(response, cancelled, timer)
+    
+    hedge_stats.record_request()
+    results = queue.Queue()
+    attempts = [UpstreamAttempt(results)]
+    threading.Thread(target=attempts[0].run, args=(messages, model, timer, sampling, cancelled), daemon=True).start()
+    
+    try:
+        pending = [results.get(timeout=hedge_stats.threshold())]
+    except queue.Empty:
+        pending = []
+        # 对冲请求不使用主请求正在等待的账号
+        excluded_sessions = {attempts[0].session_id} - {None}
+        if account_pool.get_alternate_account(excluded_sessions) is None:
+            print("[HEDGE] 没有其他可用账号，不发起对冲请求")
+        elif hedge_stats.try_acquire():
+            print(f"[HEDGE] 首包超过 {hedge_stats.threshold():.2f} 秒未到达，发起对冲请求")
+            attempts.append(UpstreamAttempt(results, hedge=True))
+            threading.Thread(
+                target=attempts[1].run,
+                args=(messages, model, timer.scoped("_hedge"), sampling, cancelled, excluded_sessions),
+                daemon=True
+            ).start()
+    
+    error = None
+    for _ in range(len(attempts)):
+        attempt, account, freeplay_events, error = pending.pop() if pending else results.get()
+        if error is None:
+            for other in attempts:
+                if other is not attempt:
+                    other.cancel()
+            if attempt.hedge:
+                hedge_stats.record_win()
+                print("[HEDGE] 对冲请求胜出")
+            return attempt.response, account, freeplay_events
+    # 所有尝试都失败，抛出最后一个错误
+    raise error
+
+# 上游在发送cost（结束标志）前就断开时返回的错误
+UPSTREAM_INCOMPLETE_ERROR = {
+    "message": "FreePlay stream ended before completion",
+    "type": "api_error"
+}
+
+def refresh_account_after_completion(account):
+    """对话结束后重新获取账号最新余额并保存"""
+    print(f"对话结束，重新获取账号 {account['email']} 的最新余额...")
+    account_pool.update_account_balance(account)
+    # 保存更新后的账号信息
+    account_pool.save_accounts()
+    
+    # 检查余额是否不足，如果不足则提示下次会切换账号
+    if account['balance'] <= 0.01:
+        print(f"账号 {account['email']} 余额不足 (${account['balance']:.4f})，下次请求将自动切换到下一个账号")
+
+def build_stream_chunk(chat_id, created, model, index, delta, finish_reason=None):
+    """构造OpenAI格式的流式chunk"""
+    return {
+        "id": chat_id,
+        "object": "chat.completion.chunk",
+        "created": created,
+        "model": model,
+        "choices": [{
+            "index": index,
+            "delta": delta,
+            "finish_reason": finish_reason
+        }]
+    }
+
+def run_stream_choice(index, messages, model, events, cancelled, timer, sampling=None, open_responses=None):
+    """在工作线程中完成一次上游生成，并把事件放入队列供主生成器合并
+    
+    上游响应会登记到 open_responses，主生成器结束时统一关闭，使卡住的choice也能被立即取消。
+    """
+    response = None
+    matcher = StopSequenceMatcher((sampling or {}).get('stop'))
+    # 收到cost或命中stop序列后才有结束原因，否则上游是中途断开的
+    finish_reason = None
+    try:
+        response, account, freeplay_events = open_upstream(messages, model, timer, sampling, cancelled)
+        if open_responses is not None:
+            open_responses.append(response)
+        # 登记前主生成器已经结束，不再继续
+        if cancelled.is_set():
+            return
+        print(f"[choice {index}] 使用账号: {account['email']} (余额: ${account['balance']:.2f})")
         
         # 检查响应状态
         if response.status_code != 200:
-            error_chunk = {
-                "error": {
-                    "message": f"FreePlay API error: {response.status_code}",
-                    "type": "api_error"
-                }
-            }
-            yield f"data: {json.dumps(error_chunk)}\n\n"
+            events.put((index, 'error', {
+                "message": f"FreePlay API error: {response.status_code}",
+                "type": "api_error"
+            }))
             return
         
-        # 发送开始chunk
-        start_chunk = {
-            "id": chat_id,
-            "object": "chat.completion.chunk",
-            "created": created,
-            "model": model,
-            "choices": [{
-                "index": 0,
-                "delta": {"role": "assistant", "content": ""},
-                "finish_reason": None
-            }]
-        }
-        yield f"data: {json.dumps(start_chunk)}\n\n"
+        events.put((index, 'start', None))
         
-        # 处理流式数据
-        for line in response.iter_lines(decode_unicode=True):
-            if line and line.startswith('data: '):
-                try:
-                    freeplay_data = json.loads(line[6:])  # 去掉 'data: ' 前缀
-                    
-                    # 检查错误
-                    if freeplay_data.get('error'):
-                        error_chunk = {
-                            "error": {
-                                "message": freeplay_data['error'],
-                                "type": "api_error"
-                            }
-                        }
-                        yield f"data: {json.dumps(error_chunk)}\n\n"
-                        return
-                    
-                    # 处理内容
-                    if freeplay_data.get('content'):
-                        chunk = {
-                            "id": chat_id,
-                            "object": "chat.completion.chunk",
-                            "created": created,
-                            "model": model,
-                            "choices": [{
-                                "index": 0,
-                                "delta": {"content": freeplay_data['content']},
-                                "finish_reason": None
-                            }]
-                        }
-                        yield f"data: {json.dumps(chunk)}\n\n"
-                    
-                    # 检查是否结束（cost字段表示结束）
-                    if freeplay_data.get('cost') is not None:
-                        # 对话结束后重新获取最新余额
-                        print(f"对话结束，重新获取账号 {account['email']} 的最新余额...")
-                        account_pool.update_account_balance(account)
-                        # 保存更新后的账号信息
-                        account_pool.save_accounts()
-                        
-                        # 检查余额是否不足，如果不足则提示下次会切换账号
-                        if account['balance'] <= 0.01:
-                            print(f"账号 {account['email']} 余额不足 (${account['balance']:.4f})，下次请求将自动切换到下一个账号")
-                        
-                        end_chunk = {
-                            "id": chat_id,
-                            "object": "chat.completion.chunk",
-                            "created": created,
-                            "model": model,
-                            "choices": [{
-                                "index": 0,
-                                "delta": {},
-                                "finish_reason": "stop"
-                            }]
-                        }
-                        yield f"data: {json.dumps(end_chunk)}\n\n"
-                        yield "data: [DONE]\n\n"
-                        return
-                        
-                except json.JSONDecodeError as e:
-                    print(f"JSON decode error: {e}, line: {line}")
-                    continue
-                except Exception as e:
-                    print(f"Error processing line: {e}, line: {line}")
-                    continue
+        for freeplay_data in freeplay_events:
+            # 检查错误
+            if freeplay_data.get('error'):
+                events.put((index, 'error', {
+                    "message": freeplay_data['error'],
+                    "type": "api_error"
+                }))
+                return
+            
+            # 处理内容
+            if freeplay_data.get('content'):
+                content, stopped = matcher.feed(freeplay_data['content'])
+                if content:
+                    events.put((index, 'content', content))
+                if stopped:
+                    print(f"[choice {index}] 命中stop序列，提前终止上游生成")
+                    finish_reason = 'stop'
+                    break
+            
+            # 检查是否结束（cost字段表示结束）
+            if freeplay_data.get('cost') is not None:
+                finish_reason = completion_finish_reason(freeplay_data)
+                break
         
-        # 如果没有正常结束，发送结束chunk
-        end_chunk = {
-            "id": chat_id,
-            "object": "chat.completion.chunk",
-            "created": created,
-            "model": model,
-            "choices": [{
-                "index": 0,
-                "delta": {},
-                "finish_reason": "stop"
-            }]
-        }
-        yield f"data: {json.dumps(end_chunk)}\n\n"
-        yield "data: [DONE]\n\n"
+        # 先关闭上游连接停止生成，再发送结束事件，最后刷新余额，
+        # 刷新余额需要额外请求FreePlay，不应推迟客户端收到结束chunk
+        response.close()
+        if finish_reason is None:
+            # 上游在发送cost前就断开，输出不完整，与上游错误同样处理
+            events.put((index, 'error', UPSTREAM_INCOMPLETE_ERROR))
+            return
+        content = matcher.flush()
+        if content:
+            events.put((index, 'content', content))
+        
+        events.put((index, 'stop', finish_reason))
+        refresh_account_after_completion(account)
         
     except Exception as e:
         print(f"Stream error: {e}")
-        error_chunk = {
-            "error": {
-                "message": f"Stream processing error: {str(e)}",
-                "type": "internal_error"
-            }
-        }
-        yield f"data: {json.dumps(error_chunk)}\n\n"
+        events.put((index, 'error', {
+            "message": f"Stream processing error: {str(e)}",
+            "type": "internal_error"
+        }))
+    finally:
+        if response is not None:
+            response.close()
 
-def generate_openai_non_stream_response(messages, model="claude-3-7-sonnet-20250219"):
-    """生成OpenAI格式的非流式响应"""
+def generate_openai_stream_response(messages, model="claude-3-7-sonnet-20250219", n=1, timer=None, sampling=None):
+    """生成OpenAI格式的流式响应，n > 1 时并发请求上游并按choice索引合并到同一个流"""
+    if timer is None:
+        timer = RequestTimer()
+    chat_id = f"chatcmpl-{uuid.uuid4().hex[:29]}"
+    created = int(time.time())
+    events = queue.Queue()
+    cancelled = threading.Event()
+    open_responses = []
+    
+    for index in range(n):
+        threading.Thread(
+            target=run_stream_choice,
+            args=(index, messages, model, events, cancelled, timer.scoped(f"_{index}") if n > 1 else timer, sampling, open_responses),
+            daemon=True
+        ).start()
+    
     try:
-        response, account = call_freeplay_api_with_retry(messages, stream=False, model=model)
+        pending = n
+        while pending:
+            index, kind, payload = events.get()
+            
+            if kind == 'start':
+                # 发送开始chunk
+                chunk = build_stream_chunk(chat_id, created, model, index, {"role": "assistant", "content": ""})
+            elif kind == 'content':
+                chunk = build_stream_chunk(chat_id, created, model, index, {"content": payload})
+            elif kind == 'stop':
+                pending -= 1
+                chunk = build_stream_chunk(chat_id, created, model, index, {}, payload)
+            else:
+                # 任意一个choice出错则终止整个流，其余choice由finally取消
+                yield f"data: {json.dumps({'error': payload})}\n\n"
+                return
+            
+            with timer.measure('serialize'):
+                data = f"data: {json.dumps(chunk)}\n\n"
+            yield data
         
+        yield "data: [DONE]\n\n"
+    finally:
+        # 客户端断开或出错时通知其余工作线程，并关闭它们的上游连接
+        cancelled.set()
+        for response in list(open_responses):
+            response.close()
+        timer.log(model=model, n=n, stream=True)
+
+def collect_choice(messages, model, timer, sampling=None):
+    """完成一次上游生成并收集完整内容，返回 (内容, finish_reason, 错误)"""
+    matcher = StopSequenceMatcher((sampling or {}).get('stop'))
+    # 收到cost或命中stop序列后才有结束原因，否则上游是中途断开的
+    finish_reason = None
+    response, account, freeplay_events = open_upstream(messages, model, timer, sampling)
+    
+    try:
         print(f"使用账号: {account['email']} (余额: ${account['balance']:.2f})")
         
         # 检查响应状态
         if response.status_code != 200:
-            return {
-                "error": {
-                    "message": f"FreePlay API error: {response.status_code}",
-                    "type": "api_error"
-                }
+            return None, None, {
+                "message": f"FreePlay API error: {response.status_code}",
+                "type": "api_error"
             }
         
         # 收集所有内容
         full_content = ""
-        cost = None
         
-        for line in response.iter_lines(decode_unicode=True):
-            if line and line.startswith('data: '):
-                try:
-                    freeplay_data = json.loads(line[6:])
-                    
-                    if freeplay_data.get('error'):
-                        return {
-                            "error": {
-                                "message": freeplay_data['error'],
-                                "type": "api_error"
-                            }
-                        }
-                    
-                    if freeplay_data.get('content'):
-                        full_content += freeplay_data['content']
-                    if freeplay_data.get('cost'):
-                        cost = freeplay_data['cost']
-                        
-                except json.JSONDecodeError:
-                    continue
-        
-        # 对话结束后重新获取最新余额
-        if cost:
-            print(f"对话结束，重新获取账号 {account['email']} 的最新余额...")
-            account_pool.update_account_balance(account)
-            # 保存更新后的账号信息
-            account_pool.save_accounts()
+        for freeplay_data in freeplay_events:
+            if freeplay_data.get('error'):
+                return None, None, {
+                    "message": freeplay_data['error'],
+                    "type": "api_error"
+                }
             
-            # 检查余额是否不足，如果不足则提示下次会切换账号
-            if account['balance'] <= 0.01:
-                print(f"账号 {account['email']} 余额不足 (${account['balance']:.4f})，下次请求将自动切换到下一个账号")
+            if freeplay_data.get('content'):
+                content, stopped = matcher.feed(freeplay_data['content'])
+                full_content += content
+                if stopped:
+                    finish_reason = 'stop'
+                    break
+            if freeplay_data.get('cost') is not None:
+                finish_reason = completion_finish_reason(freeplay_data)
+                break
+        
+        # 先关闭上游连接停止生成，再刷新余额
+        response.close()
+        if finish_reason is None:
+            return None, None, UPSTREAM_INCOMPLETE_ERROR
+        refresh_account_after_completion(account)
+        return full_content + matcher.flush(), finish_reason, None
+    finally:
+        response.close()
+
+def generate_openai_non_stream_response(messages, model="claude-3-7-sonnet-20250219", n=1, timer=None, sampling=None, prompt_tokens=None):
+    """生成OpenAI格式的非流式响应，n > 1 时并发请求上游"""
+    if timer is None:
+        timer = RequestTimer()
+    if prompt_tokens is None:
+        prompt_tokens = estimate_prompt_tokens(messages)
+    try:
+        if n == 1:
+            results = [collect_choice(messages, model, timer, sampling)]
+        else:
+            with ThreadPoolExecutor(max_workers=n) as executor:
+                results = list(executor.map(lambda index: collect_choice(messages, model, timer.scoped(f"_{index}"), sampling), range(n)))
+        
+        choices = []
+        for index, (content, finish_reason, error) in enumerate(results):
+            if error:
+                return {"error": error}
+            choices.append({
+                "index": index,
+                "message": {
+                    "role": "assistant",
+                    "content": content
+                },
+                "finish_reason": finish_reason
+            })
+        
+        # FreePlay不提供token计数，使用本地估算值
+        completion_tokens = sum(estimate_text_tokens(choice['message']['content']) for choice in choices)
         
         # 返回OpenAI格式的完整响应
         return {
@@ -649,18 +1217,11 @@ def generate_openai_non_stream_response(messages, model="claude-3-7-sonnet-20250
             "object": "chat.completion",
             "created": int(time.time()),
             "model": model,
-            "choices": [{
-                "index": 0,
-                "message": {
-                    "role": "assistant",
-                    "content": full_content
-                },
-                "finish_reason": "stop"
-            }],
+            "choices": choices,
             "usage": {
-                "prompt_tokens": 0,  # FreePlay不提供token计数
-                "completion_tokens": 0,
-                "total_tokens": 0
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens
             }
         }
         
@@ -672,6 +1233,48 @@ def generate_openai_non_stream_response(messages, model="claude-3-7-sonnet-20250
             }
         }
 
+def choose_encoding(streaming=False):
+    """根据客户端的Accept-Encoding选择压缩算法，流式响应只使用gzip"""
+    accepted = request.accept_encodings
+    if brotli is not None and not streaming and accepted['br']:
+        return 'br'
+    if accepted['gzip']:
+        return 'gzip'
+    return None
+
+def gzip_stream(chunks):
+    """逐chunk进行gzip压缩并同步刷新，保证客户端能立即解压每个事件"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31 输出gzip格式
+    try:
+        for chunk in chunks:
+            yield compressor.compress(chunk.encode('utf-8')) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield compressor.flush()
+    finally:
+        chunks.close()
+
+@app.after_request
+def compress_response(response):
+    """对较大的非流式响应进行gzip/brotli压缩"""
+    if response.is_streamed or response.direct_passthrough or 'Content-Encoding' in response.headers:
+        return response
+    if response.status_code < 200 or response.status_code in (204, 304):
+        return response
+    
+    response.vary.add('Accept-Encoding')
+    data = response.get_data()
+    if len(data) < COMPRESSION_MIN_SIZE:
+        return response
+    
+    encoding = choose_encoding()
+    if encoding == 'br':
+        response.set_data(brotli.compress(data, quality=5))
+    elif encoding == 'gzip':
+        response.set_data(gzip.compress(data, compresslevel=6))
+    else:
+        return response
+    response.headers['Content-Encoding'] = encoding
+    return response
+
 @app.route('/v1/chat/completions', methods=['POST'])
 def chat_completions():
     """OpenAI兼容的聊天完成API"""
@@ -680,6 +1283,29 @@ def chat_completions():
         messages = data.get('messages', [])
         stream = data.get('stream', False)
         model = data.get('model', 'claude-3-7-sonnet-20250219')
+        n = data.get('n', 1)
+        
+        # 验证messages
+        if not isinstance(messages, list) or not all(isinstance(message, dict) for message in messages):
+            return jsonify({
+                "error": {
+                    "message": "参数 'messages' 必须是消息对象的数组",
+                    "type": "invalid_request_error",
+                    "param": "messages",
+                    "code": "invalid_value"
+                }
+            }), 400
+        
+        # 验证choice数量
+        if not isinstance(n, int) or isinstance(n, bool) or not 1 <= n <= MAX_CHOICES:
+            return jsonify({
+                "error": {
+                    "message": f"参数 'n' 必须是 1 到 {MAX_CHOICES} 之间的整数",
+                    "type": "invalid_request_error",
+                    "param": "n",
+                    "code": "invalid_value"
+                }
+            }), 400
         
         # 验证模型
         is_valid, error_msg = validate_model(model)
@@ -693,20 +1319,73 @@ def chat_completions():
                 }
             }), 400
         
-        if stream:
-            return Response(
-                generate_openai_stream_response(messages, model),
-                mimetype='text/event-stream',
-                headers={
+        # 验证采样参数
+        sampling, error_msg, param = validate_sampling_params(data, model)
+        if error_msg:
+            return jsonify({
+                "error": {
+                    "message": error_msg,
+                    "type": "invalid_request_error",
+                    "param": param,
+                    "code": "invalid_value"
+                }
+            }), 400
+        
+        # 本地预检上下文长度，避免把注定失败的请求发往上游并在账号间重试
+        prompt_tokens, error_msg = validate_context_length(messages, model, sampling)
+        if error_msg:
+            return jsonify({
+                "error": {
+                    "message": error_msg,
+                    "type": "invalid_request_error",
+                    "param": "messages",
+                    "code": "context_length_exceeded"
+                }
+            }), 400
+        
+        # 排空中拒绝新请求，让负载均衡把流量切到其他实例
+        if not drain_state.try_enter():
+            return jsonify({
+                "error": {
+                    "message": "服务正在关闭，请重试其他实例",
+                    "type": "service_unavailable"
+                }
+            }), 503, {'Retry-After': '1'}
+        
+        # 流式响应的登记在流关闭时释放，其余情况在返回前释放
+        handed_off = False
+        try:
+            timer = RequestTimer()
+            
+            if stream:
+                # 流式响应立即发送响应头，不等待上游；各阶段耗时在流结束时写入结构化日志，
+                # 通过X-Request-Id关联，因此流式响应不带Server-Timing头
+                body = generate_openai_stream_response(messages, model, n, timer, sampling)
+                headers = {
                     'Content-Type': 'text/event-stream',
                     'Cache-Control': 'no-cache',
                     'Connection': 'keep-alive',
-                    'Access-Control-Allow-Origin': '*'
+                    'Access-Control-Allow-Origin': '*',
+                    'X-Request-Id': timer.request_id,
+                    'Vary': 'Accept-Encoding'
                 }
-            )
-        else:
-            response_data = generate_openai_non_stream_response(messages, model)
-            return jsonify(response_data)
+                if SSE_COMPRESSION and choose_encoding(streaming=True) == 'gzip':
+                    body = gzip_stream(body)
+                    headers['Content-Encoding'] = 'gzip'
+                response = Response(ClosingIterator(body, [drain_state.leave]), mimetype='text/event-stream', headers=headers)
+                handed_off = True
+                return response
+            else:
+                response_data = generate_openai_non_stream_response(messages, model, n, timer, sampling, prompt_tokens)
+                with timer.measure('serialize'):
+                    response = jsonify(response_data)
+                response.headers['Server-Timing'] = timer.server_timing()
+                response.headers['X-Request-Id'] = timer.request_id
+                timer.log(model=model, n=n, stream=False)
+                return response
+        finally:
+            if not handed_off:
+                drain_state.leave()
             
     except Exception as e:
         return jsonify({"error": {"message": str(e), "type": "request_error"}}), 500
@@ -786,6 +1465,68 @@ def reset_disabled_accounts():
         "default_balance": f"${default_balance:.4f}"
     })
 
+profile_lock = threading.Lock()
+
+def sample_stacks(seconds, interval):
+    """定时采样所有线程的调用栈，返回折叠格式的栈及其出现次数"""
+    own_thread = threading.get_ident()
+    counts = {}
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_thread:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            key = ';'.join(reversed(stack))
+            counts[key] = counts.get(key, 0) + 1
+        # 不超过截止时间，保证总耗时不超过seconds
+        time.sleep(max(0.0, min(interval, deadline - time.perf_counter())))
+    return counts
+
+@app.route('/admin/profile', methods=['GET'])
+def profile():
+    """在实时流量下采样N秒，返回可直接用于flamegraph.pl/speedscope的折叠栈"""
+    try:
+        seconds = float(request.args.get('seconds', 10))
+        interval = float(request.args.get('interval', 0.01))
+    except ValueError:
+        return jsonify({"error": {"message": "seconds 和 interval 必须是数字", "type": "invalid_request_error"}}), 400
+    
+    # 链式比较对nan/inf同样返回False，因此也会拒绝非有限值
+    if not (0 < seconds <= PROFILE_MAX_SECONDS and 0 < interval <= seconds):
+        return jsonify({"error": {"message": f"seconds 必须在 0 到 {PROFILE_MAX_SECONDS} 之间，interval 必须大于 0 且不超过 seconds", "type": "invalid_request_error"}}), 400
+    
+    # 同一时间只允许一个采样任务
+    if not profile_lock.acquire(blocking=False):
+        return jsonify({"error": {"message": "已有采样任务正在运行", "type": "conflict"}}), 409
+    
+    try:
+        counts = sample_stacks(seconds, interval)
+    finally:
+        profile_lock.release()
+    
+    body = "\n".join(f"{stack} {count}" for stack, count in sorted(counts.items()))
+    return Response(body + "\n", mimetype='text/plain')
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """运行指标"""
+    return jsonify({
+        "in_flight": drain_state.active,
+        "hedge": hedge_stats.snapshot()
+    })
+
+@app.route('/ready', methods=['GET'])
+def ready():
+    """就绪检查，开始排空后返回503，便于滚动部署时摘除流量"""
+    if drain_state.draining:
+        return jsonify({"status": "draining", "in_flight": drain_state.active}), 503
+    return jsonify({"status": "ready", "in_flight": drain_state.active})
+
 @app.route('/v1/models', methods=['GET'])
 def list_models():
     """列出支持的模型"""
@@ -797,6 +1538,7 @@ def list_models():
             "created": int(time.time()),
             "owned_by": "freeplay",
             "max_tokens": config["max_tokens"],
+            "context_window": config["context_window"],
             "model_id": config["model_id"]
         })
     
@@ -825,11 +1567,18 @@ def test():
             "accounts_status": "/accounts/status",
             "accounts_reload": "/accounts/reload",
             "update_balance": "/accounts/update-balance",
-            "reset_disabled": "/accounts/reset-disabled"
+            "reset_disabled": "/accounts/reset-disabled",
+            "profile": "/admin/profile",
+            "ready": "/ready",
+            "metrics": "/metrics"
         }
     })
 
 if __name__ == '__main__':
     print("Starting FreePlay2OpenAI API server on http://localhost:8000")
     print(f"Loaded {len(account_pool.accounts)} accounts from {account_pool.accounts_file}")
-    app.run(host='0.0.0.0', port=8000, debug=True)
\ No newline at end of file
+    # 使用HTTP/1.1以支持keep-alive，客户端可以在多次请求间复用连接
+    WSGIRequestHandler.protocol_version = "HTTP/1.1"
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    # 重载器的父进程收到SIGTERM会直接杀死子进程，因此关闭重载器以保证优雅退出
+    app.run(host='0.0.0.0', port=8000, debug=True, use_reloader=False)
\ No newline at end of file
@@ -0,0 +1,543 @@
+"""
+main.py 的单元测试
+运行: python -m unittest test_main  (或 python -m pytest test_main.py)
+"""
+import gzip
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import main
+
+
+class FakeResponse:
+    """模拟FreePlay的流式响应，stall为True时在被关闭前不产出任何数据"""
+    def __init__(self, lines, stall=False):
+        self.lines = lines
+        self.stall = stall
+        self.status_code = 200
+        self.headers = {}
+        self.text = ''
+        self.closed = threading.Event()
+
+    def iter_lines(self, decode_unicode=True):
+        if self.stall:
+            self.closed.wait(5)
+            return
+        for line in self.lines:
+            if self.closed.is_set():
+                return
+            yield line
+
+    def close(self):
+        self.closed.set()
+
+
+def make_account(index):
+    return {
+        'email': f'user{index}@example.com',
+        'password': 'password',
+        'session_id': f'session-{index}',
+        'project_id': f'project-{index}',
+        'balance': 5.0
+    }
+
+
+class AccountPoolTestCase(unittest.TestCase):
+    """使用临时账号文件和两个测试账号，避免访问网络或改写真实的accounts.txt"""
+    def setUp(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.accounts_file = os.path.join(tmp_dir, 'accounts.txt')
+        patches = [
+            mock.patch.object(main.account_pool, 'accounts', [make_account(0), make_account(1)]),
+            mock.patch.object(main.account_pool, 'accounts_file', self.accounts_file),
+            mock.patch.object(main.account_pool, 'current_index', 0),
+            mock.patch.object(main, 'get_account_balance', return_value=(5.0, True)),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        # 结束事件发出后工作线程还会刷新余额，等它们结束后再撤销上面的patch
+        existing = set(threading.enumerate())
+        self.addCleanup(self.join_new_threads, existing)
+
+    def join_new_threads(self, existing):
+        for thread in set(threading.enumerate()) - existing:
+            thread.join(5)
+
+
+def parse_sse(body):
+    """解析SSE响应体，返回数据列表（[DONE] 保留为字符串）"""
+    events = []
+    for block in body.split('\n\n'):
+        if block.startswith('data: '):
+            payload = block[6:]
+            events.append(payload if payload == '[DONE]' else json.loads(payload))
+    return events
+
+
+class FanOutTest(AccountPoolTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = main.app.test_client()
+
+    def post_completion(self, **kwargs):
+        return self.client.post('/v1/chat/completions', json={
+            'model': 'claude-4-sonnet',
+            'messages': [{'role': 'user', 'content': 'hi'}],
+            **kwargs
+        })
+
+    def test_stream_multiplexes_choices_with_own_finish_chunks(self):
+        lines = ['data: {"content": "a"}', 'data: {"content": "b"}', 'data: {"cost": 0.01}']
+        with mock.patch.object(main.requests, 'post', side_effect=lambda *a, **kw: FakeResponse(lines)):
+            events = parse_sse(self.post_completion(stream=True, n=3).get_data(as_text=True))
+
+        self.assertEqual(events[-1], '[DONE]')
+        choices = [event['choices'][0] for event in events[:-1]]
+        for index in range(3):
+            own = [choice for choice in choices if choice['index'] == index]
+            self.assertEqual(own[0]['delta'], {'role': 'assistant', 'content': ''})
+            self.assertEqual(''.join(choice['delta'].get('content', '') for choice in own), 'ab')
+            self.assertEqual([choice['finish_reason'] for choice in own if choice['finish_reason']], ['stop'])
+            self.assertIsNotNone(own[-1]['finish_reason'])
+
+    def test_non_stream_returns_n_choices(self):
+        lines = ['data: {"content": "ok"}', 'data: {"cost": 0.01}']
+        with mock.patch.object(main.requests, 'post', side_effect=lambda *a, **kw: FakeResponse(lines)):
+            data = self.post_completion(n=2).get_json()
+        self.assertEqual([choice['index'] for choice in data['choices']], [0, 1])
+        self.assertEqual([choice['message']['content'] for choice in data['choices']], ['ok', 'ok'])
+
+    def test_error_in_one_choice_cancels_the_others(self):
+        stalled = [FakeResponse([], stall=True), FakeResponse([], stall=True)]
+        failing = FakeResponse(['data: {"error": "boom"}'])
+        calls = []
+
+        def fake_post(*args, **kwargs):
+            calls.append(None)
+            # 让出错的choice等其他choice都连上之后才返回
+            if len(calls) == 3:
+                return failing
+            return stalled[len(calls) - 1]
+
+        with mock.patch.object(main.requests, 'post', side_effect=fake_post):
+            events = parse_sse(self.post_completion(stream=True, n=3).get_data(as_text=True))
+
+        self.assertEqual(events[-1]['error']['message'], 'boom')
+        self.assertNotIn('[DONE]', events)
+        for response in stalled:
+            self.assertTrue(response.closed.wait(1))
+
+    def test_invalid_n_is_rejected(self):
+        for n in (0, main.MAX_CHOICES + 1, '2', True):
+            response = self.post_completion(n=n)
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.get_json()['error']['param'], 'n')
+
+
+class ProfileTest(unittest.TestCase):
+    def setUp(self):
+        self.client = main.app.test_client()
+
+    def test_returns_collapsed_stacks(self):
+        stop = threading.Event()
+        worker = threading.Thread(target=stop.wait, daemon=True)
+        worker.start()
+        try:
+            response = self.client.get('/admin/profile?seconds=0.05&interval=0.01')
+        finally:
+            stop.set()
+        self.assertEqual(response.status_code, 200)
+        lines = response.get_data(as_text=True).strip().split('\n')
+        self.assertTrue(lines)
+        for line in lines:
+            stack, count = line.rsplit(' ', 1)
+            self.assertGreater(int(count), 0)
+        self.assertTrue(any('wait (threading.py' in line for line in lines))
+
+    def test_rejects_invalid_arguments(self):
+        for query in ('seconds=abc', 'seconds=0', f'seconds={main.PROFILE_MAX_SECONDS + 1}',
+                      'seconds=0.1&interval=3', 'seconds=0.1&interval=nan', 'seconds=nan',
+                      'seconds=0.1&interval=inf', 'seconds=0.1&interval=0'):
+            self.assertEqual(self.client.get(f'/admin/profile?{query}').status_code, 400, query)
+
+    def test_sampling_never_exceeds_seconds(self):
+        started = time.perf_counter()
+        main.sample_stacks(0.05, 0.05)
+        self.assertLess(time.perf_counter() - started, 0.5)
+
+    def test_only_one_profile_at_a_time(self):
+        with main.profile_lock:
+            self.assertEqual(self.client.get('/admin/profile?seconds=0.01').status_code, 409)
+
+
+class ServerTimingTest(AccountPoolTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = main.app.test_client()
+
+    def post_completion(self, **kwargs):
+        return self.client.post('/v1/chat/completions', json={
+            'model': 'claude-4-sonnet',
+            'messages': [{'role': 'user', 'content': 'hi'}],
+            **kwargs
+        }, buffered=False)
+
+    def test_non_stream_reports_phases(self):
+        lines = ['data: {"content": "ok"}', 'data: {"cost": 0.01}']
+        with mock.patch.object(main.requests, 'post', return_value=FakeResponse(lines)):
+            response = self.post_completion()
+        phases = dict(item.split(';dur=') for item in response.headers['Server-Timing'].split(', '))
+        for phase in ('account', 'upstream_connect', 'upstream_ttfb', 'parse', 'serialize', 'total'):
+            self.assertIn(phase, phases)
+        self.assertTrue(all(float(ms) <= float(phases['total']) for ms in phases.values()))
+        self.assertTrue(response.headers['X-Request-Id'])
+
+    def test_concurrent_choices_are_recorded_separately(self):
+        lines = ['data: {"content": "ok"}', 'data: {"cost": 0.01}']
+        with mock.patch.object(main.requests, 'post', side_effect=lambda *a, **kw: FakeResponse(lines)):
+            header = self.post_completion(n=2).headers['Server-Timing']
+        self.assertIn('upstream_ttfb_0;', header)
+        self.assertIn('upstream_ttfb_1;', header)
+        self.assertNotIn('upstream_ttfb;', header)
+
+    def test_stream_headers_are_sent_before_upstream_answers(self):
+        lines = ['data: {"content": "ok"}', 'data: {"cost": 0.01}']
+        body = {'model': 'claude-4-sonnet', 'messages': [{'role': 'user', 'content': 'hi'}], 'stream': True}
+        # 测试客户端总会先取一块响应体，这里直接分发请求以检查上游被调用之前的响应头
+        with mock.patch.object(main.requests, 'post', return_value=FakeResponse(lines)) as post:
+            with main.app.test_request_context('/v1/chat/completions', method='POST', json=body):
+                response = main.app.full_dispatch_request()
+                self.assertFalse(post.called)
+                self.assertNotIn('Server-Timing', response.headers)
+                self.assertTrue(response.headers['X-Request-Id'])
+                chunks = b''.join(response.iter_encoded())
+                response.close()
+        self.assertTrue(chunks.decode().endswith('data: [DONE]\n\n'))
+
+class StopSequenceMatcherTest(unittest.TestCase):
+    def test_stop_sequence_split_across_chunks(self):
+        matcher = main.StopSequenceMatcher(['world'])
+        first, stopped = matcher.feed('Hello wo')
+        self.assertFalse(stopped)
+        self.assertNotIn('wo', first)
+        second, stopped = matcher.feed('rld and more')
+        self.assertTrue(stopped)
+        self.assertEqual(first + second, 'Hello ')
+
+    def test_partial_match_is_flushed_at_end(self):
+        matcher = main.StopSequenceMatcher(['world'])
+        output, stopped = matcher.feed('Hello wor')
+        self.assertFalse(stopped)
+        self.assertEqual(output + matcher.flush(), 'Hello wor')
+
+    def test_earliest_stop_sequence_wins(self):
+        matcher = main.StopSequenceMatcher(['xyz', 'or'])
+        self.assertEqual(matcher.feed('Hello world xyz'), ('Hello w', True))
+
+    def test_no_stop_sequences_passes_through(self):
+        matcher = main.StopSequenceMatcher()
+        self.assertEqual(matcher.feed('abc'), ('abc', False))
+
+
+
+
+class SamplingParamsTest(unittest.TestCase):
+    model_config = main.MODEL_MAPPING['claude-4-sonnet']
+
+    def build(self, data):
+        sampling, error, _ = main.validate_sampling_params(data, 'claude-4-sonnet')
+        self.assertIsNone(error)
+        return {param['name']: param['value'] for param in main.build_upstream_params(self.model_config, sampling)}
+
+    def test_defaults_when_no_sampling_params(self):
+        params = self.build({})
+        self.assertEqual(params['temperature'], main.DEFAULT_TEMPERATURE)
+        self.assertEqual(params['top_p'], main.DEFAULT_TOP_P)
+        self.assertEqual(params['top_k'], main.DEFAULT_TOP_K)
+
+    def test_only_client_params_are_sent(self):
+        params = self.build({'temperature': 0.9, 'max_tokens': 100})
+        self.assertEqual(params, {'max_tokens': 100, 'temperature': 0.9})
+        params = self.build({'top_k': 40})
+        self.assertEqual(params['top_k'], 40)
+        self.assertNotIn('temperature', params)
+        self.assertNotIn('top_p', params)
+
+    def test_invalid_top_k_is_rejected(self):
+        for top_k in (0, 1.5, '5', True):
+            _, error, param = main.validate_sampling_params({'top_k': top_k}, 'claude-4-sonnet')
+            self.assertIsNotNone(error)
+            self.assertEqual(param, 'top_k')
+
+
+class StopOrderingTest(AccountPoolTestCase):
+    def run_choice(self, upstream):
+        events = main.queue.Queue()
+        seen = {}
+
+        def fake_refresh(account):
+            seen['closed'] = upstream.closed.is_set()
+            seen['events'] = [kind for _, kind, _ in list(events.queue)]
+
+        with mock.patch.object(main.requests, 'post', return_value=upstream), \
+                mock.patch.object(main, 'refresh_account_after_completion', side_effect=fake_refresh):
+            main.run_stream_choice(0, [{'role': 'user', 'content': 'hi'}], 'claude-4-sonnet',
+                                   events, threading.Event(), main.RequestTimer(), {'stop': ['STOP']})
+        return seen
+
+    def test_stop_hit_closes_and_finishes_before_refreshing_balance(self):
+        upstream = FakeResponse(['data: {"content": "ok STOP more"}', 'data: {"content": "never"}'])
+        seen = self.run_choice(upstream)
+        self.assertTrue(seen['closed'])
+        self.assertEqual(seen['events'], ['start', 'content', 'stop'])
+
+    def test_non_stream_stop_hit_closes_before_refreshing_balance(self):
+        upstream = FakeResponse(['data: {"content": "ok STOP more"}'])
+        closed = []
+        with mock.patch.object(main.requests, 'post', return_value=upstream), \
+                mock.patch.object(main, 'refresh_account_after_completion',
+                                  side_effect=lambda account: closed.append(upstream.closed.is_set())):
+            result = main.collect_choice([{'role': 'user', 'content': 'hi'}], 'claude-4-sonnet',
+                                         main.RequestTimer(), {'stop': ['STOP']})
+        self.assertEqual(result, ('ok ', 'stop', None))
+        self.assertEqual(closed, [True])
+
+
+class FinishReasonTest(AccountPoolTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = main.app.test_client()
+
+    def post_completion(self, lines, **kwargs):
+        with mock.patch.object(main.requests, 'post', side_effect=lambda *a, **kw: FakeResponse(lines)):
+            return self.client.post('/v1/chat/completions', json={
+                'model': 'claude-4-sonnet',
+                'messages': [{'role': 'user', 'content': 'hi'}],
+                **kwargs
+            })
+
+    def test_upstream_reason_is_used(self):
+        lines = ['data: {"content": "ok"}', 'data: {"cost": 0.01, "stop_reason": "max_tokens"}']
+        data = self.post_completion(lines).get_json()
+        self.assertEqual(data['choices'][0]['finish_reason'], 'length')
+
+    def test_missing_upstream_reason_is_stop_even_near_max_tokens(self):
+        lines = ['data: {"content": "' + 'word ' * 20 + '"}', 'data: {"cost": 0.01}']
+        data = self.post_completion(lines, max_tokens=5).get_json()
+        self.assertEqual(data['choices'][0]['finish_reason'], 'stop')
+
+    def test_stream_ending_without_cost_is_an_error(self):
+        response = self.post_completion(['data: {"content": "partial"}'], stream=True)
+        events = parse_sse(response.get_data(as_text=True))
+        self.assertEqual(events[-1]['error'], main.UPSTREAM_INCOMPLETE_ERROR)
+        self.assertNotIn('[DONE]', events)
+        self.assertFalse(any(event['choices'][0]['finish_reason'] for event in events[:-1]))
+
+    def test_non_stream_ending_without_cost_is_an_error(self):
+        response = self.post_completion(['data: {"content": "partial"}'])
+        self.assertEqual(response.get_json()['error'], main.UPSTREAM_INCOMPLETE_ERROR)
+
+
+class CompressionTest(AccountPoolTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = main.app.test_client()
+
+    def post_completion(self, content, accept_encoding, **kwargs):
+        lines = [f'data: {json.dumps({"content": content})}', 'data: {"cost": 0.01}']
+        with mock.patch.object(main.requests, 'post', side_effect=lambda *a, **kw: FakeResponse(lines)):
+            response = self.client.post('/v1/chat/completions', json={
+                'model': 'claude-4-sonnet',
+                'messages': [{'role': 'user', 'content': 'hi'}],
+                **kwargs
+            }, headers={'Accept-Encoding': accept_encoding})
+            response.get_data()
+        return response
+
+    def test_large_response_is_gzipped(self):
+        response = self.post_completion('x' * 2000, 'gzip')
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+        data = json.loads(gzip.decompress(response.get_data()))
+        self.assertEqual(data['choices'][0]['message']['content'], 'x' * 2000)
+
+    def test_small_response_is_not_compressed(self):
+        response = self.post_completion('ok', 'gzip')
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+        self.assertLess(len(response.get_data()), main.COMPRESSION_MIN_SIZE)
+
+    def test_refused_encoding_is_not_used(self):
+        response = self.post_completion('x' * 2000, 'gzip;q=0, identity')
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+
+    def test_brotli_is_preferred_when_available(self):
+        fake_brotli = mock.Mock(compress=lambda data, quality: b'br:' + data)
+        with mock.patch.object(main, 'brotli', fake_brotli):
+            response = self.post_completion('x' * 2000, 'gzip, br')
+        self.assertEqual(response.headers['Content-Encoding'], 'br')
+        self.assertTrue(response.get_data().startswith(b'br:'))
+
+    def test_brotli_is_skipped_when_not_installed(self):
+        with mock.patch.object(main, 'brotli', None):
+            response = self.post_completion('x' * 2000, 'br, gzip')
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+
+    def test_stream_is_gzipped_per_event_when_enabled(self):
+        fake_brotli = mock.Mock(compress=lambda data, quality: b'br:' + data)
+        with mock.patch.object(main, 'SSE_COMPRESSION', True), mock.patch.object(main, 'brotli', fake_brotli):
+            response = self.post_completion('ok', 'br, gzip', stream=True)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        events = parse_sse(gzip.decompress(response.get_data()).decode())
+        self.assertEqual(events[-1], '[DONE]')
+
+    def test_stream_is_not_compressed_by_default(self):
+        response = self.post_completion('ok', 'gzip', stream=True)
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(parse_sse(response.get_data(as_text=True))[-1], '[DONE]')
+
+
+class DrainTest(AccountPoolTestCase):
+    def setUp(self):
+        super().setUp()
+        self.drain_state = main.DrainState()
+        patch = mock.patch.object(main, 'drain_state', self.drain_state)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.client = main.app.test_client()
+
+    def post_completion(self, **kwargs):
+        lines = ['data: {"content": "hi"}', 'data: {"cost": 0.01}']
+        with mock.patch.object(main.requests, 'post', return_value=FakeResponse(lines)):
+            return self.client.post('/v1/chat/completions', json={
+                'model': 'claude-4-sonnet',
+                'messages': [{'role': 'user', 'content': 'hi'}],
+                **kwargs
+            }, buffered=False)
+
+    def test_stream_releases_drain_counter_on_close(self):
+        response = self.post_completion(stream=True)
+        self.assertEqual(self.drain_state.active, 1)
+        self.assertTrue(response.get_data(as_text=True).endswith('data: [DONE]\n\n'))
+        self.assertEqual(self.drain_state.active, 1)
+        response.close()
+        self.assertEqual(self.drain_state.active, 0)
+        self.assertTrue(self.drain_state.wait_idle(0))
+
+    def test_non_stream_releases_drain_counter(self):
+        response = self.post_completion()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.drain_state.active, 0)
+
+    def test_draining_rejects_new_requests(self):
+        self.drain_state.start_draining()
+        self.assertEqual(self.post_completion().status_code, 503)
+        self.assertEqual(self.client.get('/ready').status_code, 503)
+        self.assertEqual(self.drain_state.active, 0)
+
+
+class TokenEstimateTest(unittest.TestCase):
+    def test_cjk_counts_one_token_per_character(self):
+        self.assertEqual(main.estimate_text_tokens('你好世界'), 4)
+        self.assertEqual(main.estimate_text_tokens('abcdefgh'), 2)
+        self.assertEqual(main.estimate_text_tokens('你好abcd'), 3)
+
+    def test_multimodal_image_uses_fixed_estimate(self):
+        image = {'type': 'image_url', 'image_url': {'url': 'data:image/png;base64,' + 'A' * 1000000}}
+        text_only = [{'role': 'user', 'content': [{'type': 'text', 'text': 'describe'}]}]
+        with_image = [{'role': 'user', 'content': [{'type': 'text', 'text': 'describe'}, image]}]
+        self.assertEqual(
+            main.estimate_prompt_tokens(with_image),
+            main.estimate_prompt_tokens(text_only) + main.IMAGE_TOKEN_ESTIMATE
+        )
+
+    def test_message_estimates_are_cached_by_digest(self):
+        text = '共享的长对话前缀 ' * 100
+        main.estimate_message_tokens('user', text)
+        self.assertNotIn(text, [key[1] for key in main.token_cache])
+        with mock.patch.object(main, 'estimate_text_tokens', side_effect=AssertionError('cache miss')):
+            main.estimate_message_tokens('user', text)
+
+
+class HedgeTest(AccountPoolTestCase):
+    def setUp(self):
+        super().setUp()
+        self.stats = main.HedgeStats()
+        patches = [
+            mock.patch.object(main, 'HEDGE_ENABLED', True),
+            mock.patch.object(main, 'HEDGE_AFTER_SECONDS', 0.05),
+            mock.patch.object(main, 'HEDGE_MAX_RATIO', 1.0),
+            mock.patch.object(main, 'hedge_stats', self.stats),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_hedge_wins_on_other_account_and_loser_is_closed(self):
+        stalled = FakeResponse([], stall=True)
+        fast = FakeResponse(['data: {"content": "fast"}', 'data: {"cost": 0.01}'])
+        sessions = []
+
+        def fake_post(url, cookies=None, **kwargs):
+            sessions.append(cookies['session'])
+            return stalled if len(sessions) == 1 else fast
+
+        with mock.patch.object(main.requests, 'post', side_effect=fake_post):
+            response, account, events = main.open_upstream([], 'claude-4-sonnet', main.RequestTimer())
+            self.assertIs(response, fast)
+            self.assertEqual([data.get('content') for data in events], ['fast', None])
+
+        self.assertEqual(sessions, ['session-0', 'session-1'])
+        self.assertTrue(stalled.closed.is_set())
+        self.assertEqual((self.stats.hedged, self.stats.hedge_wins), (1, 1))
+        # 被取消的慢请求也记录了（删失的）首包样本
+        self.assertEqual(len(self.stats.first_byte_samples), 2)
+        self.assertGreaterEqual(max(self.stats.first_byte_samples), 0.05)
+
+    def test_hedge_rate_is_capped(self):
+        with mock.patch.object(main, 'HEDGE_MAX_RATIO', 0.5):
+            self.stats.record_request()
+            self.assertTrue(self.stats.try_acquire())
+            self.stats.record_request()
+            self.assertFalse(self.stats.try_acquire())
+            self.assertEqual(self.stats.capped, 1)
+
+    def test_threshold_uses_p95_of_samples(self):
+        with mock.patch.object(main, 'HEDGE_AFTER_SECONDS', 0):
+            self.assertEqual(self.stats.threshold(), main.HEDGE_DEFAULT_SECONDS)
+            for value in range(1, 101):
+                self.stats.record_first_byte(value / 100)
+            self.assertEqual(self.stats.threshold(), 0.95)
+
+    def test_losing_attempt_stops_retrying(self):
+        release = threading.Event()
+        failing = FakeResponse([])
+        failing.status_code = 502
+        fast = FakeResponse(['data: {"content": "fast"}', 'data: {"cost": 0.01}'])
+        sessions = []
+
+        def fake_post(url, cookies=None, **kwargs):
+            sessions.append(cookies['session'])
+            if len(sessions) == 1:
+                # 首个请求在对冲请求胜出后才返回错误，此时不应再换账号重试
+                release.wait(5)
+                return failing
+            return fast
+
+        with mock.patch.object(main.requests, 'post', side_effect=fake_post):
+            response, account, events = main.open_upstream([], 'claude-4-sonnet', main.RequestTimer())
+            self.assertIs(response, fast)
+            release.set()
+            self.assertTrue(failing.closed.wait(1))
+        self.assertEqual(len(sessions), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()